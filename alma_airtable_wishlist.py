@@ -15,7 +15,9 @@ from pathlib import Path
 import logging
 from logging import FileHandler
 import async_fetch
+import snapshot
 import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 # Path should lead to the dashboard home directory. Can be changed for testing purposes.
@@ -25,13 +27,25 @@ path = Path('./')
 with open(path / 'db/config.yml', 'r') as f:
     config = yaml.load(f, Loader=yaml.FullLoader)
 
+# Number of pooled postgres connections, which is also the number of tables/views loaded in parallel
+POOL_SIZE = config.get('pg_pool', {}).get('pool_size', 4)
+
 # Create the postgres engine
 # Credentials are in the config file 
-engine = sqlalchemy.create_engine('postgresql://{user}:{password}@{host}:{port}/{database}'.format(**config['pg_credentials']))
+engine = sqlalchemy.create_engine('postgresql://{user}:{password}@{host}:{port}/{database}'.format(**config['pg_credentials']),
+                                  pool_size=POOL_SIZE,
+                                  max_overflow=0)
+
+# Session settings (e.g., work_mem) applied to each transaction that loads a table or builds a view
+SESSION_SETTINGS = config.get('pg_session', {})
 
 # Rate limit for Airtable
 RATE_LIMIT = config['airtable']['rate_limit']
 
+# Directory for the nightly Parquet snapshots of each report
+ARCHIVE_DIR = path / config.get('archive', {}).get('path', 'archive')
+ARCHIVE_COMPRESSION = config.get('archive', {}).get('compression', 'snappy')
+
 # Set up logging to use a file on disk
 wishlist_log = logging.getLogger('wishlist')
 wishlist_log.setLevel(logging.INFO)
@@ -235,41 +249,118 @@ def fetch_analytics_data():
                                         'renewal_date')
     return reports
 
-def load_analytics_data(reports):
-    '''Loads a dictionary of pandas DataFrames to a local postgres database.'''
+def run_tasks(tasks, dependencies=None, max_workers=POOL_SIZE):
+    '''Runs a dictionary of callables, keyed by name, in parallel on a pool of threads.
+    dependencies should map a task name to a list of task names that must finish before it starts. Names not present in tasks are ignored.
+    Returns a dictionary mapping each task name to its return value.'''
+    dependencies = dependencies or {}
+    pending = dict(tasks)
+    running = {}
+    done = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Start every task whose prerequisites have all finished
+            for name in list(pending):
+                if all((d in done) or (d not in tasks) for d in dependencies.get(name, [])):
+                    running[executor.submit(pending.pop(name))] = name
+            if not running:
+                raise ValueError('Circular dependency among tasks: {}'.format(list(pending)))
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done[running.pop(future)] = future.result()
+    return done
+
+def apply_session_settings(conn, settings):
+    '''Applies postgres settings to the current transaction only, so that pooled connections are returned to the pool unchanged.'''
+    for name, value in settings.items():
+        conn.execute('select set_config(%(name)s, %(value)s, true)', name=name, value=str(value))
+
+def drop_tables(names):
+    '''Drops the tables named, along with the materialized views that depend on them.'''
     # Need explicitly to DROP the tables before re-loading, because otherwise the materialized views will throw a dependency error
+    # Done in a single transaction, since concurrent cascading drops can deadlock on the shared views
     drop_query = 'drop table if exists {table_name} cascade'
-    for r in reports:
-        engine.execute(drop_query.format(table_name=r))
-    for name, table in reports.items():
+    with engine.begin() as conn:
+        for name in names:
+            conn.execute(drop_query.format(table_name=name))
+
+def wrap_load_table(name, table):
+    '''Wrapper function using closures to bind a DataFrame to a task for run_tasks that loads it to postgres.'''
+    def load_table():
         try:
-            # Add timestamp
-            table['timestamp'] = datetime.datetime.today()
-            table.to_sql(name, engine, 
-                 if_exists='replace',
-                 index=False)
+            # Add timestamp, unless the table already carries the time it was fetched (e.g., when restored from a snapshot)
+            if 'timestamp' not in table.columns:
+                table['timestamp'] = datetime.datetime.today()
+            with engine.begin() as conn:
+                # The tables are rebuilt from Analytics on every run, so we don't need to wait on the WAL flush at commit
+                apply_session_settings(conn, dict(SESSION_SETTINGS, synchronous_commit='off'))
+                table.to_sql(name, conn, 
+                     if_exists='replace',
+                     index=False)
         except Exception as e:
             wishlist_log.error('SQL error on {} table: {}'.format(name, e))
+    return load_table
 
+def wrap_build_view(key, query, params):
+    '''Wrapper function using closures to bind a query and its parameters to a task for run_tasks that creates a materialized view.'''
+    def build_view():
+        try:
+            with engine.begin() as conn:
+                apply_session_settings(conn, SESSION_SETTINGS)
+                conn.execute(query, **params)
+        except Exception as e:
+            wishlist_log.error('SQL error on mat view {}: {}'.format(key, e))
+    return build_view
 
-def refresh_views():
-    '''Recreates the materialized views to reflect the updated data.'''
-    # Drop the dates view, since it won't be dropped in the DROP TABLE CASCADE call above
-    engine.execute('drop materialized view if exists dates')
+def view_tasks():
+    '''Returns a dictionary of tasks for run_tasks, one for each materialized view in the config.'''
     # Maps parameters to the names of queries and query paramaters
     param_dict = {'dates_view': {'start_date': config['fiscal_period']['start_date'],
                             'last_valid_renewal': config['fiscal_period']['last_valid_renewal']},
              'expenditures_view': {'start_date': config['fiscal_period']['start_date'],
                                   'end_date': config['fiscal_period']['end_date']},
              'encumbrances_view': {}}
+    tasks = {}
     for key, value in config['sql'].items():
         # Load the SQL for creating each view
         with open(path / 'db/{}'.format(value), 'r') as f:
-            query = f.read()
-            try:
-                engine.execute(query, **param_dict[key])
-            except Exception as e:
-                wishlist_log.error('SQL error on mat view {}: {}'.format(key, e))
+            tasks[key] = wrap_build_view(key, f.read(), param_dict[key])
+    return tasks
+
+def update_database(reports):
+    '''Loads a dictionary of pandas DataFrames to a local postgres database and recreates the materialized views to reflect the updated data. 
+    Tables are loaded in parallel, one per pooled connection. Each view is built as soon as the tables listed for it under view_dependencies in the config have been loaded; a view not listed there waits for every table.'''
+    views = view_tasks()
+    # Tables and views share one set of task names, so they must not overlap
+    collisions = set(reports) & set(views)
+    if collisions:
+        raise ValueError('Report names clash with view names in the config: {}'.format(sorted(collisions)))
+    view_dependencies = config.get('view_dependencies', {})
+    dependencies = {key: view_dependencies.get(key, list(reports)) for key in views}
+    drop_tables(reports)
+    # Drop the dates view, since it won't be dropped in the DROP TABLE CASCADE call above
+    engine.execute('drop materialized view if exists dates')
+    tasks = {name: wrap_load_table(name, table) for name, table in reports.items()}
+    tasks.update(views)
+    run_tasks(tasks, dependencies)
+
+def archive_reports(reports, run_date):
+    '''Saves a dictionary of pandas DataFrames as Parquet snapshots for the given run date.
+    Errors are logged, so that a failed snapshot doesn't hold up the database update.'''
+    for name, table in reports.items():
+        try:
+            snapshot.write_snapshot(ARCHIVE_DIR, run_date, name, table, compression=ARCHIVE_COMPRESSION)
+        except Exception as e:
+            wishlist_log.error('Error archiving {} table: {}'.format(name, e))
+
+def restore_snapshot(run_date, names=None):
+    '''Reloads the postgres tables and materialized views from the snapshots for a past run date, without calling the APIs. 
+    If names is supplied, only those tables are restored.'''
+    reports = snapshot.read_snapshot(ARCHIVE_DIR, run_date, names)
+    if not reports:
+        raise AssertionError('No snapshots found for {}'.format(run_date))
+    update_database(reports)
+    return reports
 
 def check_results(results):
     '''Error handler to check results of batch updates and log errors.
@@ -370,7 +461,8 @@ def get_airtable_rows(url, headers, params):
 
 def fetch_new_orders(wishlist_funds_table, orders_url, allocations_url, headers):
     '''Get rows from the Airtable wishlist orders table and joins with the table of wishlist fund allocations.
-    Argument should be a DataFrame containing updated fund information.'''
+    Argument should be a DataFrame containing updated fund information.
+    Returns the joined table, or None if it could not be fetched.'''
     # If the row has a POL, ignore it
     params = {'filterByFormula': '{pol_number} = ""'}
     try:
@@ -415,7 +507,8 @@ def fetch_new_orders(wishlist_funds_table, orders_url, allocations_url, headers)
         # Add timestamp
         wishlist_orders_table['timestamp'] = datetime.datetime.today()
         # Save to the postgres db
-        return wishlist_orders_table.to_sql('wishlist_orders_table', engine, if_exists='replace', index=False)
+        wishlist_orders_table.to_sql('wishlist_orders_table', engine, if_exists='replace', index=False)
+        return wishlist_orders_table
     except Exception as e:
         wishlist_log.error(e)
 
@@ -423,6 +516,7 @@ def do_airtable_updates(reports, init=False):
     '''Parent function for handling Airtable updates: getting, patching, and posting data.
     Reports should be a dictionary of DataFrames returned from the fetch_analytics_data function.
     Set the init flag to True if starting a new Airtable database.
+    Returns the table of new orders from fetch_new_orders.
     '''
     GET_HEADERS = {'Authorization': 'Bearer {api_key}'.format(api_key=config['airtable']['api_key'])}
     # Use for patch, put, and post
@@ -494,18 +588,23 @@ def do_airtable_updates(reports, init=False):
                             headers=GET_HEADERS)
 # Main program loop
 if __name__ == '__main__':
+    # Use a single run date and time for all of this run's tables and snapshots
+    run_time = datetime.datetime.today()
     # 1. Get latest data from Analytics
     print('getting latest data from Analytics...')
     reports = fetch_analytics_data()
-    # 2. Load local postgres tables
-    print('loading postgres tables...')
-    load_analytics_data(reports)
-    # 3. Update materialized views for faster search
-    print('updating postgres views')
-    refresh_views()
-    # 4. a. Update Airtable data with Alma funds
+    for table in reports.values():
+        table['timestamp'] = run_time
+    # Keep a copy of today's reports in the archive
+    archive_reports(reports, run_time.date())
+    # 2. Load local postgres tables and update materialized views for faster search
+    print('loading postgres tables and updating views...')
+    update_database(reports)
+    # 3. a. Update Airtable data with Alma funds
     #.   b. Load local postgres tables with new order on Airtable
     print('getting Airtable data and updating...')
-    do_airtable_updates(reports)
+    wishlist_orders_table = do_airtable_updates(reports)
+    if wishlist_orders_table is not None:
+        archive_reports({'wishlist_orders_table': wishlist_orders_table}, run_time.date())
 
 
@@ -0,0 +1,73 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import json
+import datetime
+from pathlib import Path
+
+MANIFEST = 'manifest.json'
+
+def partition_path(archive_dir, run_date):
+    '''Returns the directory for a given run date's snapshots, partitioned in the form run_date=YYYY-MM-DD.'''
+    return Path(archive_dir) / 'run_date={}'.format(pd.to_datetime(run_date).date().isoformat())
+
+def read_manifest(archive_dir):
+    '''Returns the list of snapshot entries recorded in the archive's manifest, or an empty list if no snapshots have been written.'''
+    manifest_path = Path(archive_dir) / MANIFEST
+    if not manifest_path.exists():
+        return []
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def write_manifest(archive_dir, entries):
+    '''Writes the manifest to a temporary file first, so that a failed write doesn't clobber the existing index.'''
+    manifest_path = Path(archive_dir) / MANIFEST
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(entries, f, indent=2)
+    tmp_path.replace(manifest_path)
+
+def write_snapshot(archive_dir, run_date, name, df, compression='snappy'):
+    '''Saves a DataFrame as a compressed Parquet file in the partition for run_date, and records it in the manifest.
+    Re-running on the same date replaces that date's snapshot of the report.'''
+    run_path = partition_path(archive_dir, run_date)
+    run_path.mkdir(parents=True, exist_ok=True)
+    file_path = run_path / '{}.parquet'.format(name)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # Parquet doesn't store nanosecond timestamps by default; pandas dates carry no more precision than microseconds anyway
+    pq.write_table(table, str(file_path),
+                   compression=compression,
+                   coerce_timestamps='us',
+                   allow_truncated_timestamps=True)
+    entry = {'run_date': run_path.name.split('=')[1],
+            'report': name,
+            'file': str(file_path.relative_to(archive_dir)),
+            'rows': len(df),
+            'columns': list(df.columns),
+            'bytes': file_path.stat().st_size,
+            'created': datetime.datetime.today().isoformat()}
+    entries = [e for e in read_manifest(archive_dir)
+                if (e['run_date'], e['report']) != (entry['run_date'], name)]
+    entries.append(entry)
+    write_manifest(archive_dir, sorted(entries, key=lambda e: (e['run_date'], e['report'])))
+    return entry
+
+def read_snapshot(archive_dir, run_date, names=None):
+    '''Loads the snapshots for a given run date into a dictionary of DataFrames, keyed by report name.
+    Files are memory-mapped rather than read into a buffer first.
+    If names is supplied, only those reports are loaded.'''
+    run_date = partition_path(archive_dir, run_date).name.split('=')[1]
+    reports = {}
+    for entry in read_manifest(archive_dir):
+        if entry['run_date'] != run_date:
+            continue
+        if names and entry['report'] not in names:
+            continue
+        table = pq.read_table(str(Path(archive_dir) / entry['file']), memory_map=True)
+        df = table.to_pandas()
+        # pyarrow returns list columns (e.g., Airtable linked records) as numpy arrays, which psycopg2 can't load
+        for field in table.schema:
+            if pa.types.is_list(field.type):
+                df[field.name] = table.column(field.name).to_pylist()
+        reports[entry['report']] = df
+    return reports
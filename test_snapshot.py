@@ -0,0 +1,62 @@
+import pytest
+import datetime
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+import snapshot
+
+RUN_TIME = datetime.datetime(2020, 3, 1, 2, 30, 15, 123456)
+
+def make_pol_table():
+    '''Mimics pol_table after normalize_dates: the row-wise apply leaves every column with object dtype.'''
+    df = pd.DataFrame({'po_line_reference': ['POL-1', 'POL-2', 'POL-3'],
+                      'transaction_amount': [100.0, None, 25.5],
+                      'renewal_date': pd.to_datetime(['2018-08-01', None, '2019-09-15']),
+                      'fund_ledger_code': ['123456ABC', None, '654321DEF']})
+    df = df.astype(object).apply(lambda row: row, axis=1)
+    df['renewal_date'] = pd.Series([pd.Timestamp('2019-08-01'), pd.NaT, pd.Timestamp('2019-09-15')], dtype=object)
+    df['timestamp'] = RUN_TIME
+    return df
+
+def make_orders_table():
+    '''Mimics the Airtable wishlist orders: linked-record fields are lists, and fields empty in Airtable are NaN or blank.'''
+    return pd.DataFrame({'id': ['rec1', 'rec2'],
+                        'title': ['Journal of Examples', 'Example Database'],
+                        'allocations': [['recA', 'recB'], float('nan')],
+                        'fund_to_allocate': [['recF'], ['recG']],
+                        'amount': [500.0, float('nan')],
+                        'pol_number': ['', ''],
+                        'timestamp': [RUN_TIME, RUN_TIME]})
+
+def test_pol_table_round_trip(tmp_path):
+    df = make_pol_table()
+    snapshot.write_snapshot(tmp_path, RUN_TIME.date(), 'pol_table', df)
+    restored = snapshot.read_snapshot(tmp_path, RUN_TIME.date())['pol_table']
+    assert list(restored.columns) == list(df.columns)
+    assert restored.po_line_reference.tolist() == df.po_line_reference.tolist()
+    assert restored.transaction_amount.fillna(-1).tolist() == [100.0, -1, 25.5]
+    assert restored.renewal_date.iloc[0] == pd.Timestamp('2019-08-01')
+    assert pd.isnull(restored.renewal_date.iloc[1])
+    # The fetch time must survive, since the dashboard shows it as the refresh time
+    assert (restored.timestamp == pd.Timestamp(RUN_TIME)).all()
+
+def test_orders_table_round_trip(tmp_path):
+    df = make_orders_table()
+    snapshot.write_snapshot(tmp_path, RUN_TIME.date(), 'wishlist_orders_table', df)
+    restored = snapshot.read_snapshot(tmp_path, RUN_TIME.date())['wishlist_orders_table']
+    assert list(restored.columns) == list(df.columns)
+    # Linked records come back as plain lists, so that to_sql can load them as postgres arrays
+    assert restored.allocations.iloc[0] == ['recA', 'recB']
+    assert restored.allocations.iloc[1] is None
+    assert restored.fund_to_allocate.tolist() == [['recF'], ['recG']]
+    assert restored.pol_number.tolist() == ['', '']
+    assert (restored.timestamp == pd.Timestamp(RUN_TIME)).all()
+
+def test_manifest_replaces_same_day_snapshot(tmp_path):
+    df = make_orders_table()
+    snapshot.write_snapshot(tmp_path, RUN_TIME.date(), 'wishlist_orders_table', df)
+    snapshot.write_snapshot(tmp_path, RUN_TIME.date(), 'wishlist_orders_table', df.head(1))
+    snapshot.write_snapshot(tmp_path, '2020-03-02', 'wishlist_orders_table', df)
+    manifest = snapshot.read_manifest(tmp_path)
+    assert [(e['run_date'], e['rows']) for e in manifest] == [('2020-03-01', 1), ('2020-03-02', 2)]
+    assert len(snapshot.read_snapshot(tmp_path, '2020-03-01', names=['pol_table'])) == 0